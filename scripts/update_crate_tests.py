@@ -16,25 +16,37 @@
 """Add or update tests to TEST_MAPPING.
 
 This script uses Bazel to find reverse dependencies on a crate and generates a
-TEST_MAPPING file. It accepts the absolute path to a crate as argument. If no
-argument is provided, it assumes the crate is the current directory.
+TEST_MAPPING file. It accepts the absolute paths to one or more crates as
+arguments. If no argument is provided, it assumes the crate is the current
+directory.
 
   Usage:
   $ . build/envsetup.sh
   $ lunch aosp_arm64-eng
   $ update_crate_tests.py $ANDROID_BUILD_TOP/external/rust/crates/libc
 
+Generating the Bazel workspace takes a few minutes and is only done once per
+invocation. When updating several crates, pass all of them at once:
+
+  $ update_crate_tests.py $ANDROID_BUILD_TOP/external/rust/crates/*
+
+or, from Python, call main_batch() with the list of paths.
+
 This script is automatically called by external_updater.
 """
 
 import argparse
+import collections
+import concurrent.futures
 import glob
+import hashlib
 import json
 import os
 import platform
 import re
 import subprocess
 import sys
+import tempfile
 from datetime import datetime
 from pathlib import Path
 
@@ -53,7 +65,7 @@ TEST_GROUPS = [
 ]
 
 # Excluded tests. These tests will be ignored by this script.
-TEST_EXCLUDE = [
+TEST_EXCLUDE = frozenset([
         "ash_test_src_lib",
         "ash_test_tests_constant_size_arrays",
         "ash_test_tests_display",
@@ -72,7 +84,7 @@ TEST_EXCLUDE = [
 
         # TODO: Remove when b/198197213 is closed.
         "diced_client_test",
-]
+])
 
 # Excluded modules.
 EXCLUDE_PATHS = [
@@ -82,8 +94,58 @@ EXCLUDE_PATHS = [
         "//external/vm_tools"
 ]
 
-LABEL_PAT = re.compile('^//(.*):.*$')
-EXTERNAL_PAT = re.compile('^//external/rust/')
+EXTERNAL_PREFIX = '//external/rust/'
+
+# Labels of a node or an edge in the output of "bazel query --output=graph".
+GRAPH_LABEL_PAT = re.compile('"([^"]+)"')
+
+# Build files of a crate. The TEST_MAPPING of a crate is only regenerated when
+# one of them changed since its last update.
+BUILD_FILES = frozenset(["BUILD", "BUILD.bazel", "Android.bp", "Cargo.toml"])
+
+# Size of the chunks read when hashing the build files.
+HASH_CHUNK_SIZE = 1 << 16
+
+# Directory where the digests of the last updates are kept.
+CACHE_DIR = os.path.join(os.path.expanduser("~"), ".cache", "update_crate_tests")
+
+
+def _iter_build_files(root):
+    """Yields the paths of the build files under root, in order.
+
+    Directories that cannot be read are skipped, as os.walk does.
+    """
+    try:
+        with os.scandir(root) as it:
+            entries = sorted(it, key=lambda e: e.name)
+    except OSError:
+        return
+    for entry in entries:
+        if entry.is_dir(follow_symlinks=False):
+            if entry.name != ".git":
+                yield from _iter_build_files(entry.path)
+        elif entry.name in BUILD_FILES:
+            yield entry.path
+
+
+def _hash_file(h, path, buf):
+    """Feeds the content of a file to h, returns False if it does not exist.
+
+    The file is read in chunks into buf, a bytearray shared between calls.
+    """
+    try:
+        fd = os.open(path, os.O_RDONLY)
+    except FileNotFoundError:
+        return False
+    try:
+        mv = memoryview(buf)
+        while True:
+            n = os.readv(fd, [buf])
+            if not n:
+                return True
+            h.update(mv[:n])
+    finally:
+        os.close(fd)
 
 
 class UpdaterException(Exception):
@@ -108,6 +170,48 @@ class Env(object):
                                    'select a target.')
 
 
+class Cache(object):
+    """A persistent cache, stored as a JSON file in CACHE_DIR.
+
+    Each entry is associated with a digest of its inputs. An entry is only
+    returned if its digest matches the current one.
+
+    Attributes:
+      path: The path to the JSON file.
+      entries: A dictionary of the cached entries, indexed by key.
+    """
+    def __init__(self, name):
+        self.path = os.path.join(CACHE_DIR, name)
+        try:
+            with open(self.path) as cache_file:
+                self.entries = json.load(cache_file)
+        except (OSError, ValueError):
+            self.entries = {}
+
+    def get(self, key, digest):
+        """Returns the value for key, or None if missing or out of date."""
+        entry = self.entries.get(key)
+        if entry is None or entry["digest"] != digest:
+            return None
+        return entry["value"]
+
+    def put(self, key, digest, value):
+        """Stores value for key and saves the cache.
+
+        The cache is only an optimization: a failure to save it is reported
+        as a warning.
+        """
+        self.entries[key] = {"digest": digest, "value": value}
+        tmp_path = self.path + ".tmp"
+        try:
+            os.makedirs(CACHE_DIR, exist_ok=True)
+            with open(tmp_path, "w") as cache_file:
+                json.dump(self.entries, cache_file)
+            os.replace(tmp_path, self.path)
+        except OSError as e:
+            print("Warning: unable to save %s: %s" % (self.path, e), file=sys.stderr)
+
+
 class Bazel(object):
     """Bazel wrapper.
 
@@ -116,14 +220,16 @@ class Bazel(object):
 
     Attributes:
       path: The path to the bazel executable.
+      top: The path to the top of the repository, where Bazel is called from.
+      output_bases: The Bazel output bases used to run queries in parallel.
+        None means the default output base.
     """
-    def __init__(self, env):
+    def __init__(self, env, jobs=1):
         """Constructor.
 
-        Note that the current directory is changed to ANDROID_BUILD_TOP.
-
         Args:
           env: An instance of Env.
+          jobs: The number of Bazel servers used to run queries in parallel.
 
         Raises:
           UpdaterException: an error occurred while calling soong_ui.
@@ -131,72 +237,167 @@ class Bazel(object):
         if platform.system() != 'Linux':
             raise UpdaterException('This script has only been tested on Linux.')
         self.path = os.path.join(env.ANDROID_BUILD_TOP, "tools", "bazel")
+        self.top = env.ANDROID_BUILD_TOP
         soong_ui = os.path.join(env.ANDROID_BUILD_TOP, "build", "soong", "soong_ui.bash")
+        # A Bazel server runs one query at a time. Each job gets its own output
+        # base, hence its own server. These servers are stopped by shutdown();
+        # their output bases are kept so that later runs reuse their caches.
+        # query_many_packages never runs more than two queries at once.
+        jobs = min(jobs, 2)
+        if jobs > 1:
+            self.output_bases = [os.path.join(env.ANDROID_BUILD_TOP, "out", "queryview_%d" % i)
+                                 for i in range(jobs)]
+        else:
+            self.output_bases = [None]
+        # A //path/... pattern which matches nothing fails the whole query, so
+        # only the paths present in this checkout are excluded.
+        self._exclude_expr = " + ".join(
+            path + "/..." for path in EXCLUDE_PATHS
+            if os.path.isdir(os.path.join(self.top, path.lstrip("/"))))
 
         # soong_ui requires to be at the root of the repository.
-        os.chdir(env.ANDROID_BUILD_TOP)
         print("Generating Bazel files...")
         cmd = [soong_ui, "--make-mode", "bp2build"]
         try:
-            subprocess.check_output(cmd, stderr=subprocess.STDOUT, text=True)
+            subprocess.check_output(cmd, stderr=subprocess.STDOUT, text=True, cwd=self.top)
         except subprocess.CalledProcessError as e:
             raise UpdaterException('Unable to generate bazel workspace: ' + e.output)
 
         print("Building Bazel Queryview. This can take a couple of minutes...")
         cmd = [soong_ui, "--build-mode", "--all-modules", "--dir=.", "queryview"]
         try:
-            subprocess.check_output(cmd, stderr=subprocess.STDOUT, text=True)
+            subprocess.check_output(cmd, stderr=subprocess.STDOUT, text=True, cwd=self.top)
         except subprocess.CalledProcessError as e:
             raise UpdaterException('Unable to update TEST_MAPPING: ' + e.output)
 
-    def query_modules(self, path):
-        """Returns all modules for a given path."""
-        cmd = self.path + " query --config=queryview /" + path + ":all"
-        out = subprocess.check_output(cmd, shell=True, stderr=subprocess.DEVNULL, text=True).strip().split("\n")
-        modules = set()
-        for line in out:
-            # speed up by excluding unused modules.
-            if "windows_x86" in line:
-                continue
-            modules.add(line)
-        return modules
-
-    def query_rdeps(self, module):
-        """Returns all reverse dependencies for a single module."""
-        cmd = (self.path + " query --config=queryview \'rdeps(//..., " +
-                module + ")\' --output=label_kind")
-        out = (subprocess.check_output(cmd, shell=True, stderr=subprocess.DEVNULL, text=True)
-                .strip().split("\n"))
-        if '' in out:
-            out.remove('')
-        return out
-
-    def exclude_module(self, module):
-        for path in EXCLUDE_PATHS:
-            if module.startswith(path):
-                return True
-        return False
+    def query(self, expr, output_base=None, output=("--output=label",)):
+        """Yields the output lines of a Bazel query.
+
+        The output of Bazel is parsed while the query is still running.
+
+        Args:
+          expr: The query expression.
+          output_base: The Bazel output base to use, if not the default one.
+          output: The Bazel options selecting the output format.
+        """
+        # The expression may exceed the maximum length of a command line, pass
+        # it through a file instead.
+        with tempfile.NamedTemporaryFile("w", suffix=".query") as query_file:
+            query_file.write(expr)
+            query_file.flush()
+            cmd = [self.path]
+            if output_base:
+                cmd.append("--output_base=" + output_base)
+            cmd += ["query", "--config=queryview",
+                    "--query_file=" + query_file.name]
+            cmd += output
+            with subprocess.Popen(cmd, stdout=subprocess.PIPE, stderr=subprocess.DEVNULL,
+                                  text=True, bufsize=1 << 20, cwd=self.top) as proc:
+                for line in proc.stdout:
+                    line = line.rstrip("\n")
+                    if line:
+                        yield line
+            if proc.returncode != 0:
+                raise subprocess.CalledProcessError(proc.returncode, cmd)
+
+    def exclude(self, expr):
+        """Returns expr without the targets under EXCLUDE_PATHS."""
+        if not self._exclude_expr:
+            return expr
+        return expr + ' except (' + self._exclude_expr + ')'
+
+    def query_rdep_tests_dirs(self, path, output_base=None):
+        """Returns all reverse dependency tests for modules in this package.
+
+        A single query looks up the rust_test targets outside of EXCLUDE_PATHS
+        which depend on any module of the package.
+
+        Args:
+          path: The relative path of the package.
+          output_base: The Bazel output base to use, if not the default one.
+        """
+        expr = self.exclude('kind("^rust_test_? rule$", rdeps(//..., /' + path + ':all))')
+        return self.split_rdeps(path, self.query(expr, output_base))
 
-    def query_rdep_tests_dirs(self, modules, path):
-        """Returns all reverse dependency tests for modules in this package."""
+    def split_rdeps(self, path, rdeps):
+        """Splits the reverse dependency tests of a package.
+
+        Tests in this package or outside of //external/rust/ are returned by
+        name. For other crates, their directory is returned instead, so that
+        their TEST_MAPPING is imported.
+
+        Returns:
+          A (rdep_tests, rdep_dirs) tuple.
+        """
         rdep_tests = set()
         rdep_dirs = set()
-        path_pat = re.compile("^/%s:.*$" % path)
-        for module in modules:
-            for rdep in self.query_rdeps(module):
-                rule_type, _, mod = rdep.split(" ")
-                if rule_type == "rust_test_" or rule_type == "rust_test":
-                    if self.exclude_module(mod):
-                        continue
-                    path_match = path_pat.match(mod)
-                    if path_match or not EXTERNAL_PAT.match(mod):
-                        rdep_tests.add(mod.split(":")[1].split("--")[0])
-                    else:
-                        label_match = LABEL_PAT.match(mod)
-                        if label_match:
-                            rdep_dirs.add(label_match.group(1))
+        path_prefix = "/%s:" % path
+        for mod in rdeps:
+            if mod.startswith(path_prefix) or not mod.startswith(EXTERNAL_PREFIX):
+                rdep_tests.add(mod.partition(":")[2].partition("--")[0])
+            else:
+                # Strip the leading "//" and the target name.
+                rdep_dirs.add(mod[2:].partition(":")[0])
         return (rdep_tests, rdep_dirs)
 
+    def query_many_packages(self, paths):
+        """Returns the reverse dependency tests and directories of packages.
+
+        Two queries are shared by all the packages: the rust_test targets
+        depending on any of their modules, and the reverse dependency graph of
+        these modules. Each test is then attributed to the packages it depends
+        on by walking the graph. When possible, both queries run concurrently
+        on separate output bases.
+
+        Args:
+          paths: The relative paths of the packages.
+
+        Returns:
+          A dictionary of (rdep_tests, rdep_dirs) tuples, indexed by path.
+        """
+        if len(paths) == 1:
+            return {paths[0]: self.query_rdep_tests_dirs(paths[0], self.output_bases[0])}
+        rdeps = 'rdeps(//..., ' + " + ".join("/" + path + ":all" for path in paths) + ')'
+        queries = [
+            (self.exclude('kind("^rust_test_? rule$", ' + rdeps + ')'), ("--output=label",)),
+            (rdeps, ("--output=graph", "--nograph:factored", "--graph:node_limit=-1")),
+        ]
+        with concurrent.futures.ThreadPoolExecutor(max_workers=len(self.output_bases)) as executor:
+            futures = [executor.submit(lambda e, b, o: list(self.query(e, b, o)), expr,
+                                       self.output_bases[i % len(self.output_bases)], output)
+                       for (i, (expr, output)) in enumerate(queries)]
+            (tests, graph) = [future.result() for future in futures]
+
+        # An edge goes from a target to one of its dependencies.
+        rdeps_of = collections.defaultdict(list)
+        modules = collections.defaultdict(set)
+        for line in graph:
+            labels = GRAPH_LABEL_PAT.findall(line)
+            if len(labels) == 2:
+                rdeps_of[labels[1]].append(labels[0])
+            for label in labels:
+                modules[label.partition(":")[0][1:]].add(label)
+        tests = set(tests)
+        result = {}
+        for path in paths:
+            seen = set(modules[path])
+            stack = list(seen)
+            while stack:
+                for rdep in rdeps_of[stack.pop()]:
+                    if rdep not in seen:
+                        seen.add(rdep)
+                        stack.append(rdep)
+            result[path] = self.split_rdeps(path, seen & tests)
+        return result
+
+    def shutdown(self):
+        """Stops the Bazel servers started for the parallel jobs."""
+        for output_base in self.output_bases:
+            if output_base:
+                subprocess.call([self.path, "--output_base=" + output_base, "shutdown"],
+                                stdout=subprocess.DEVNULL, stderr=subprocess.DEVNULL,
+                                cwd=self.top)
+
 
 class Package(object):
     """A Bazel package.
@@ -207,16 +408,15 @@ class Package(object):
       rdep_tests: The list of computed reverse dependencies.
       rdep_dirs: The list of computed reverse dependency directories.
     """
-    def __init__(self, path, env, bazel):
+    def __init__(self, path, env):
         """Constructor.
 
-        Note that the current directory is changed to the package location when
-        called.
+        The reverse dependencies are initially empty, see
+        set_rdep_tests_dirs.
 
         Args:
           path: Path to the package.
           env: An instance of Env.
-          bazel: An instance of Bazel.
 
         Raises:
           UpdaterException: the package does not appear to belong to the
@@ -231,66 +431,105 @@ class Package(object):
                             'directory of a crate or pass its absolute path '
                             'as the argument.')
 
-        # Move to the package_directory.
-        os.chdir(self.dir)
-        modules = bazel.query_modules(self.dir_rel)
-        (self.rdep_tests, self.rdep_dirs) = bazel.query_rdep_tests_dirs(modules, self.dir_rel)
+        self.rdep_tests = set()
+        self.rdep_dirs = set()
 
     def get_rdep_tests_dirs(self):
         return (self.rdep_tests, self.rdep_dirs)
 
+    def set_rdep_tests_dirs(self, rdep_tests_dirs):
+        (self.rdep_tests, self.rdep_dirs) = rdep_tests_dirs
+
+    def build_files(self):
+        """Yields the paths of the build files of this package, in order."""
+        return _iter_build_files(self.dir)
+
 
 class TestMapping(object):
     """A TEST_MAPPING file.
 
     Attributes:
       package: The package associated with this TEST_MAPPING file.
+      path: The absolute path to this TEST_MAPPING file.
+      cache: An instance of Cache holding the digest of the last update, or
+        None if the digests are not used.
     """
-    def __init__(self, env, bazel, path):
+    def __init__(self, package, cache):
         """Constructor.
 
         Args:
-          env: An instance of Env.
-          bazel: An instance of Bazel.
-          path: The absolute path to the package.
+          package: An instance of Package.
+          cache: An instance of Cache.
+        """
+        self.package = package
+        self.path = os.path.join(package.dir, "TEST_MAPPING")
+        self.cache = cache
+
+    def digest(self):
+        """Returns a digest of the inputs of this TEST_MAPPING file.
+
+        It covers the build files of the package, the TEST_MAPPING file itself,
+        the configuration of this script and its modification time.
         """
-        self.package = Package(path, env, bazel)
+        h = hashlib.blake2b()
+        h.update(str(os.path.getmtime(__file__)).encode())
+        h.update(json.dumps([TEST_OPTIONS, sorted(TEST_EXCLUDE), TEST_GROUPS,
+                             EXCLUDE_PATHS]).encode())
+        buf = bytearray(HASH_CHUNK_SIZE)
+        for path in list(self.package.build_files()) + [self.path]:
+            h.update(os.path.relpath(path, self.package.dir).encode() + b"\0")
+            if _hash_file(h, path, buf):
+                h.update(b"\0")
+        return h.hexdigest()
+
+    def is_up_to_date(self):
+        """Returns whether nothing changed since the last recorded update.
+
+        Only the inputs covered by digest() are checked. Reverse dependencies
+        added or removed in other packages are not detected.
+        """
+        return self.cache.get(self.package.dir, self.digest()) is not None
+
+    def record(self):
+        """Records the current digest as the last successful update.
+
+        The cache is keyed by the absolute path of the package, which includes
+        ANDROID_BUILD_TOP, so separate checkouts do not share their entries.
+        """
+        self.cache.put(self.package.dir, self.digest(), True)
 
     def create(self):
         """Generates the TEST_MAPPING file."""
         (tests, dirs) = self.package.get_rdep_tests_dirs()
         if not bool(tests) and not bool(dirs):
-            if os.path.isfile('TEST_MAPPING'):
-                os.remove('TEST_MAPPING')
-            return
-        test_mapping = self.tests_dirs_to_mapping(tests, dirs)
-        self.write_test_mapping(test_mapping)
+            if os.path.isfile(self.path):
+                os.remove(self.path)
+        else:
+            test_mapping = self.tests_dirs_to_mapping(tests, dirs)
+            self.write_test_mapping(test_mapping)
 
     def tests_dirs_to_mapping(self, tests, dirs):
         """Translate the test list into a dictionary."""
-        test_mapping = {"imports": []}
+        # The same tests are added to every group, build their list once.
+        group = [{"name": test, "options": TEST_OPTIONS[test]} if test in TEST_OPTIONS
+                 else {"name": test}
+                 for test in tests if test not in TEST_EXCLUDE]
+        group.sort(key=lambda t: t["name"])
+        test_mapping = {"imports": sorted(({"path": dir} for dir in dirs),
+                                          key=lambda t: t["path"])}
         for test_group in TEST_GROUPS:
-            test_mapping[test_group] = []
-            for test in tests:
-                if test in TEST_EXCLUDE:
-                    continue
-                if test in TEST_OPTIONS:
-                    test_mapping[test_group].append({"name": test, "options": TEST_OPTIONS[test]})
-                else:
-                    test_mapping[test_group].append({"name": test})
-            test_mapping[test_group] = sorted(test_mapping[test_group], key=lambda t: t["name"])
-        for dir in dirs:
-            test_mapping["imports"].append({"path": dir})
-        test_mapping["imports"] = sorted(test_mapping["imports"], key=lambda t: t["path"])
+            test_mapping[test_group] = list(group)
         test_mapping = {section: entry for (section, entry) in test_mapping.items() if entry}
         return test_mapping
 
     def write_test_mapping(self, test_mapping):
         """Writes the TEST_MAPPING file."""
-        with open("TEST_MAPPING", "w") as json_file:
-            json_file.write("// Generated by update_crate_tests.py for tests that depend on this crate.\n")
-            json.dump(test_mapping, json_file, indent=2, separators=(',', ': '), sort_keys=True)
-            json_file.write("\n")
+        # tests_dirs_to_mapping already emits the keys and entries in sorted
+        # order, there is no need for json to sort them again.
+        payload = (b"// Generated by update_crate_tests.py for tests that depend on this crate.\n" +
+                   json.dumps(test_mapping, indent=2, separators=(',', ': ')).encode() + b"\n")
+        with open(self.path, "wb") as json_file:
+            json_file.write(payload)
         print("TEST_MAPPING successfully updated for %s!" % self.package.dir_rel)
 
 
@@ -305,40 +544,93 @@ def parse_args():
     parser.add_argument('--push_change',
                         action='store_true',
                         help='Pushes change to Gerrit.')
+    parser.add_argument('--jobs', '-j',
+                        type=int,
+                        default=1,
+                        help='Number of Bazel servers used to run queries in parallel '
+                             '(at most 2). With more than one, the servers use output bases '
+                             'under out/queryview_<n> and are shut down on exit.')
+    parser.add_argument('--skip_unchanged',
+                        action='store_true',
+                        help='Skips the crates whose build files did not change since '
+                             'their last update. Reverse dependencies added in other '
+                             'crates are then missed.')
     return parser.parse_args()
 
 
-def main():
-    args = parse_args()
-    paths = args.paths if len(args.paths) > 0 else [os.getcwd()]
+def main_batch(paths, branch_and_commit=False, push_change=False, jobs=1,
+               skip_unchanged=False):
+    """Updates the TEST_MAPPING files of multiple crates.
+
+    The Bazel workspace is generated once and shared by all the crates. With
+    skip_unchanged, crates whose build files did not change since their last
+    update are skipped, and Bazel is not called at all if all of them are.
+
+    Args:
+      paths: A list of absolute or relative paths of the crates, as globs.
+      branch_and_commit: Whether to start a new branch and commit changes.
+      push_change: Whether to push the changes to Gerrit.
+      jobs: The number of Bazel servers used to run queries in parallel.
+      skip_unchanged: Whether to skip the crates that did not change since
+        their last update.
+
+    Raises:
+      UpdaterException: an error occurred while updating a crate.
+      subprocess.CalledProcessError: an external command failed.
+    """
     # We want to use glob to get all the paths, so we first convert to absolute.
     paths = [Path(path).resolve() for path in paths]
     paths = sorted([path for abs_path in paths
                     for path in glob.glob(str(abs_path))])
 
     env = Env()
-    bazel = Bazel(env)
+    cache = Cache("test_mapping.json") if skip_unchanged else None
+    test_mappings = []
     for path in paths:
-        try:
-            test_mapping = TestMapping(env, bazel, path)
-            test_mapping.create()
-            changed = (subprocess.call(['git', 'diff', '--quiet']) == 1)
-            untracked = (os.path.isfile('TEST_MAPPING') and
-                         (subprocess.run(['git', 'ls-files', '--error-unmatch', 'TEST_MAPPING'],
-                                         stderr=subprocess.DEVNULL,
-                                         stdout=subprocess.DEVNULL).returncode == 1))
-            if args.branch_and_commit and (changed or untracked):
-                subprocess.check_output(['repo', 'start',
-                                         'tmp_auto_test_mapping', '.'])
-                subprocess.check_output(['git', 'add', 'TEST_MAPPING'])
-                subprocess.check_output(['git', 'commit', '-m',
-                                         'Update TEST_MAPPING\n\nTest: None'])
-            if args.push_change and (changed or untracked):
-                date = datetime.today().strftime('%m-%d')
-                subprocess.check_output(['git', 'push', 'aosp', 'HEAD:refs/for/master',
-                                         '-o', 'topic=test-mapping-%s' % date])
-        except (UpdaterException, subprocess.CalledProcessError) as err:
-            sys.exit("Error: " + str(err))
+        test_mapping = TestMapping(Package(path, env), cache)
+        if skip_unchanged and test_mapping.is_up_to_date():
+            print("TEST_MAPPING is up to date for %s." % test_mapping.package.dir_rel)
+            continue
+        test_mappings.append(test_mapping)
+    if not test_mappings:
+        return
+    bazel = Bazel(env, jobs)
+    try:
+        rdeps = bazel.query_many_packages([t.package.dir_rel for t in test_mappings])
+    finally:
+        bazel.shutdown()
+    for test_mapping in test_mappings:
+        path = test_mapping.package.dir
+        test_mapping.package.set_rdep_tests_dirs(rdeps[test_mapping.package.dir_rel])
+        test_mapping.create()
+        changed = (subprocess.call(['git', 'diff', '--quiet'], cwd=path) == 1)
+        untracked = (os.path.isfile(test_mapping.path) and
+                     (subprocess.run(['git', 'ls-files', '--error-unmatch', 'TEST_MAPPING'],
+                                     stderr=subprocess.DEVNULL,
+                                     stdout=subprocess.DEVNULL,
+                                     cwd=path).returncode == 1))
+        if branch_and_commit and (changed or untracked):
+            subprocess.check_output(['repo', 'start',
+                                     'tmp_auto_test_mapping', '.'], cwd=path)
+            subprocess.check_output(['git', 'add', 'TEST_MAPPING'], cwd=path)
+            subprocess.check_output(['git', 'commit', '-m',
+                                     'Update TEST_MAPPING\n\nTest: None'], cwd=path)
+        if push_change and (changed or untracked):
+            date = datetime.today().strftime('%m-%d')
+            subprocess.check_output(['git', 'push', 'aosp', 'HEAD:refs/for/master',
+                                     '-o', 'topic=test-mapping-%s' % date], cwd=path)
+        if skip_unchanged:
+            test_mapping.record()
+
+
+def main():
+    args = parse_args()
+    paths = args.paths if len(args.paths) > 0 else [os.getcwd()]
+    try:
+        main_batch(paths, args.branch_and_commit, args.push_change, args.jobs,
+                   args.skip_unchanged)
+    except (UpdaterException, subprocess.CalledProcessError) as err:
+        sys.exit("Error: " + str(err))
 
 if __name__ == '__main__':
   main()
@@ -0,0 +1,422 @@
+# Copyright 2026 Google Inc. All rights reserved.
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#     http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+import hashlib
+import os
+import tempfile
+import unittest
+from unittest import mock
+
+import update_crate_tests
+
+
+class FakeEnv(object):
+
+  def __init__(self, top):
+    self.ANDROID_BUILD_TOP = top
+
+
+def create_file(path, content=""):
+  os.makedirs(os.path.dirname(path), exist_ok=True)
+  with open(path, "w") as f:
+    f.write(content)
+
+
+class TempDirTestCase(unittest.TestCase):
+
+  def setUp(self):
+    self.tmp = tempfile.TemporaryDirectory()
+    self.addCleanup(self.tmp.cleanup)
+    self.top = os.path.join(self.tmp.name, "top")
+    self.crate = os.path.join(self.top, "external", "rust", "crates", "foo")
+    os.makedirs(self.crate)
+    patcher = mock.patch.object(update_crate_tests, "CACHE_DIR",
+                                os.path.join(self.tmp.name, "cache"))
+    patcher.start()
+    self.addCleanup(patcher.stop)
+
+  def new_test_mapping(self, cache_name="test_mapping.json"):
+    package = update_crate_tests.Package(self.crate, FakeEnv(self.top))
+    return update_crate_tests.TestMapping(package,
+                                          update_crate_tests.Cache(cache_name))
+
+
+class CacheTestCase(TempDirTestCase):
+
+  def test_missing_file(self):
+    cache = update_crate_tests.Cache("cache.json")
+    self.assertEqual(cache.entries, {})
+    self.assertIsNone(cache.get("key", "digest"))
+
+  def test_round_trip(self):
+    update_crate_tests.Cache("cache.json").put("key", "digest", [1, 2])
+    cache = update_crate_tests.Cache("cache.json")
+    self.assertEqual(cache.get("key", "digest"), [1, 2])
+
+  def test_digest_mismatch(self):
+    update_crate_tests.Cache("cache.json").put("key", "digest", True)
+    cache = update_crate_tests.Cache("cache.json")
+    self.assertIsNone(cache.get("key", "other"))
+    self.assertIsNone(cache.get("other", "digest"))
+
+  def test_corrupt_file(self):
+    create_file(os.path.join(update_crate_tests.CACHE_DIR, "cache.json"), "{not json")
+    cache = update_crate_tests.Cache("cache.json")
+    self.assertEqual(cache.entries, {})
+    cache.put("key", "digest", True)
+    self.assertTrue(update_crate_tests.Cache("cache.json").get("key", "digest"))
+
+  def test_unwritable_dir(self):
+    create_file(update_crate_tests.CACHE_DIR)
+    cache = update_crate_tests.Cache("cache.json")
+    with mock.patch("sys.stderr"):
+      cache.put("key", "digest", True)
+    self.assertTrue(cache.get("key", "digest"))
+
+
+class BuildFilesTestCase(TempDirTestCase):
+
+  def test_build_files(self):
+    for name in ["Android.bp", "Cargo.toml", "src/lib.rs", "b/BUILD.bazel",
+                 "a/BUILD", "a/other.bp", ".git/BUILD", "README.md"]:
+      create_file(os.path.join(self.crate, name))
+    files = list(update_crate_tests._iter_build_files(self.crate))
+    self.assertEqual([os.path.relpath(f, self.crate) for f in files],
+                     ["Android.bp", "Cargo.toml", "a/BUILD", "b/BUILD.bazel"])
+
+  def test_unreadable_dir(self):
+    create_file(os.path.join(self.crate, "Android.bp"))
+    create_file(os.path.join(self.crate, "a", "BUILD"))
+    create_file(os.path.join(self.crate, "b", "BUILD"))
+    scandir = os.scandir
+
+    def fake_scandir(path):
+      if path == os.path.join(self.crate, "a"):
+        raise PermissionError(path)
+      return scandir(path)
+
+    with mock.patch.object(update_crate_tests.os, "scandir", fake_scandir):
+      files = list(update_crate_tests._iter_build_files(self.crate))
+    self.assertEqual([os.path.relpath(f, self.crate) for f in files],
+                     ["Android.bp", "b/BUILD"])
+
+  def test_hash_file(self):
+    path = os.path.join(self.crate, "Android.bp")
+    content = "x" * (update_crate_tests.HASH_CHUNK_SIZE * 2 + 3)
+    create_file(path, content)
+    h = hashlib.blake2b()
+    buf = bytearray(update_crate_tests.HASH_CHUNK_SIZE)
+    self.assertTrue(update_crate_tests._hash_file(h, path, buf))
+    self.assertEqual(h.hexdigest(), hashlib.blake2b(content.encode()).hexdigest())
+
+  def test_hash_missing_file(self):
+    h = hashlib.blake2b()
+    buf = bytearray(update_crate_tests.HASH_CHUNK_SIZE)
+    self.assertFalse(update_crate_tests._hash_file(h, os.path.join(self.crate, "BUILD"), buf))
+
+
+class DigestTestCase(TempDirTestCase):
+
+  def setUp(self):
+    super().setUp()
+    create_file(os.path.join(self.crate, "Android.bp"), "rust_library {}")
+
+  def test_not_recorded(self):
+    self.assertFalse(self.new_test_mapping().is_up_to_date())
+
+  def test_recorded(self):
+    self.new_test_mapping().record()
+    self.assertTrue(self.new_test_mapping().is_up_to_date())
+
+  def test_build_file_changed(self):
+    self.new_test_mapping().record()
+    create_file(os.path.join(self.crate, "Android.bp"), "rust_test {}")
+    self.assertFalse(self.new_test_mapping().is_up_to_date())
+
+  def test_other_file_changed(self):
+    self.new_test_mapping().record()
+    create_file(os.path.join(self.crate, "src", "lib.rs"), "fn main() {}")
+    self.assertTrue(self.new_test_mapping().is_up_to_date())
+
+  def test_test_mapping_removed(self):
+    create_file(os.path.join(self.crate, "TEST_MAPPING"), "{}")
+    self.new_test_mapping().record()
+    os.remove(os.path.join(self.crate, "TEST_MAPPING"))
+    self.assertFalse(self.new_test_mapping().is_up_to_date())
+
+  def test_other_checkout(self):
+    self.new_test_mapping().record()
+    self.top = os.path.join(self.tmp.name, "other_top")
+    self.crate = os.path.join(self.top, "external", "rust", "crates", "foo")
+    create_file(os.path.join(self.crate, "Android.bp"), "rust_library {}")
+    self.assertFalse(self.new_test_mapping().is_up_to_date())
+
+
+class TestMappingTestCase(TempDirTestCase):
+
+  def create(self, tests, dirs):
+    test_mapping = self.new_test_mapping()
+    test_mapping.package.set_rdep_tests_dirs((tests, dirs))
+    test_mapping.create()
+    return test_mapping
+
+  def test_output(self):
+    test_mapping = self.create(
+        {"foo_test", "ring_test_src_lib", "open_then_run", "bar_test"},
+        {"external/rust/crates/quux", "external/rust/crates/baz"})
+    with open(test_mapping.path) as f:
+      self.assertEqual(f.read(), """\
+// Generated by update_crate_tests.py for tests that depend on this crate.
+{
+  "imports": [
+    {
+      "path": "external/rust/crates/baz"
+    },
+    {
+      "path": "external/rust/crates/quux"
+    }
+  ],
+  "presubmit": [
+    {
+      "name": "bar_test"
+    },
+    {
+      "name": "foo_test"
+    },
+    {
+      "name": "ring_test_src_lib",
+      "options": [
+        {
+          "test-timeout": "100000"
+        }
+      ]
+    }
+  ],
+  "presubmit-rust": [
+    {
+      "name": "bar_test"
+    },
+    {
+      "name": "foo_test"
+    },
+    {
+      "name": "ring_test_src_lib",
+      "options": [
+        {
+          "test-timeout": "100000"
+        }
+      ]
+    }
+  ]
+}
+""")
+
+  def test_mapping(self):
+    test_mapping = self.new_test_mapping().tests_dirs_to_mapping(
+        {"b_test", "a_test", "aidl_test_rust_client"}, set())
+    self.assertEqual(list(test_mapping), update_crate_tests.TEST_GROUPS)
+    for test_group in update_crate_tests.TEST_GROUPS:
+      self.assertEqual(test_mapping[test_group], [{"name": "a_test"}, {"name": "b_test"}])
+    test_mapping["presubmit"].append({"name": "c_test"})
+    self.assertEqual(len(test_mapping["presubmit-rust"]), 2)
+
+  def test_only_imports(self):
+    test_mapping = self.create({"open_then_run"}, {"external/rust/crates/baz"})
+    with open(test_mapping.path) as f:
+      self.assertEqual(f.read(), """\
+// Generated by update_crate_tests.py for tests that depend on this crate.
+{
+  "imports": [
+    {
+      "path": "external/rust/crates/baz"
+    }
+  ]
+}
+""")
+
+  def test_no_tests(self):
+    create_file(os.path.join(self.crate, "TEST_MAPPING"), "{}")
+    test_mapping = self.create(set(), set())
+    self.assertFalse(os.path.exists(test_mapping.path))
+
+  def test_overwrite(self):
+    create_file(os.path.join(self.crate, "TEST_MAPPING"), "x" * 4096)
+    test_mapping = self.create({"foo_test"}, set())
+    with open(test_mapping.path, "rb") as f:
+      content = f.read()
+    self.assertTrue(content.startswith(b"// Generated by update_crate_tests.py"))
+    self.assertTrue(content.endswith(b"}\n"))
+    self.assertNotIn(b"x", content.replace(b"presubmit", b""))
+
+  def test_create_does_not_record(self):
+    self.create({"foo_test"}, set())
+    self.assertFalse(self.new_test_mapping().is_up_to_date())
+
+
+FAKE_BAZEL = """#!/bin/sh
+for arg in "$@"; do
+  case "$arg" in
+    --query_file=*) cat "${arg#--query_file=}" >> "$0.queries"; echo >> "$0.queries";;
+    --output_base=*) echo "${arg#--output_base=}" >> "$0.output_bases";;
+    --output=graph) graph=1;;
+  esac
+done
+if [ -n "$graph" ]; then cat "$0.graph"; else cat "$0.out"; fi
+exit $(cat "$0.exit" 2>/dev/null || echo 0)
+"""
+
+RDEPS = """//external/rust/crates/foo:foo_test--x86_64
+//external/rust/crates/foo:foo_test--arm64
+//external/rust/crates/bar:bar_test
+//system/baz:baz_test--host
+"""
+
+GRAPH = """digraph mygraph {
+  node [shape=box];
+  "//external/rust/crates/foo:libfoo"
+  "//external/rust/crates/bar:libbar" -> "//external/rust/crates/foo:libfoo"
+  "//external/rust/crates/foo:foo_test--x86_64" -> "//external/rust/crates/foo:libfoo"
+  "//external/rust/crates/foo:foo_test--arm64" -> "//external/rust/crates/foo:libfoo"
+  "//external/rust/crates/bar:bar_test" -> "//external/rust/crates/bar:libbar"
+  "//system/baz:baz_test--host" -> "//external/rust/crates/bar:libbar"
+  "//external/rust/crates/qux:libqux"
+  "//system/qux:qux_test" -> "//external/rust/crates/qux:libqux"
+}
+"""
+
+GRAPH_TESTS = """//external/rust/crates/foo:foo_test--x86_64
+//external/rust/crates/foo:foo_test--arm64
+//external/rust/crates/bar:bar_test
+//system/baz:baz_test--host
+//system/qux:qux_test
+"""
+
+PACKAGES = ["/external/rust/crates/foo", "/external/rust/crates/bar", "/external/rust/crates/qux"]
+
+
+class BazelTestCase(TempDirTestCase):
+
+  def setUp(self):
+    super().setUp()
+    self.fake_bazel = os.path.join(self.tmp.name, "bazel")
+    create_file(self.fake_bazel, FAKE_BAZEL)
+    os.chmod(self.fake_bazel, 0o755)
+    create_file(self.fake_bazel + ".out", RDEPS)
+
+  def new_bazel(self, jobs=1):
+    with mock.patch.object(update_crate_tests.subprocess, "check_output"), \
+         mock.patch("builtins.print"):
+      bazel = update_crate_tests.Bazel(FakeEnv(self.top), jobs)
+    bazel.path = self.fake_bazel
+    return bazel
+
+  def read_fake(self, suffix):
+    with open(self.fake_bazel + suffix) as f:
+      return f.read().splitlines()
+
+  def test_query(self):
+    labels = list(self.new_bazel().query("//a:all"))
+    self.assertEqual(labels, RDEPS.splitlines())
+    self.assertEqual(self.read_fake(".queries"), ["//a:all"])
+
+  def test_query_failure(self):
+    create_file(self.fake_bazel + ".exit", "1")
+    with self.assertRaises(update_crate_tests.subprocess.CalledProcessError):
+      list(self.new_bazel().query("//a:all"))
+
+  def test_query_rdep_tests_dirs(self):
+    bazel = self.new_bazel()
+    self.assertEqual(bazel.query_rdep_tests_dirs("/external/rust/crates/foo"),
+                     ({"foo_test", "baz_test"}, {"external/rust/crates/bar"}))
+    self.assertEqual(self.read_fake(".queries"), [
+        'kind("^rust_test_? rule$", rdeps(//..., //external/rust/crates/foo:all))'])
+
+  def test_exclude_existing_paths(self):
+    os.makedirs(os.path.join(self.top, "external", "crosvm"))
+    os.makedirs(os.path.join(self.top, "external", "vm_tools"))
+    self.new_bazel().query_rdep_tests_dirs("/external/rust/crates/foo")
+    self.assertEqual(self.read_fake(".queries"), [
+        'kind("^rust_test_? rule$", rdeps(//..., //external/rust/crates/foo:all))'
+        ' except (//external/crosvm/... + //external/vm_tools/...)'])
+
+  def test_query_many_packages_single(self):
+    rdeps = self.new_bazel().query_many_packages(["/external/rust/crates/foo"])
+    self.assertEqual(rdeps, {
+        "/external/rust/crates/foo": ({"foo_test", "baz_test"}, {"external/rust/crates/bar"})})
+    self.assertEqual(len(self.read_fake(".queries")), 1)
+
+  def test_query_many_packages(self):
+    create_file(self.fake_bazel + ".out", GRAPH_TESTS)
+    create_file(self.fake_bazel + ".graph", GRAPH)
+    rdeps = self.new_bazel().query_many_packages(PACKAGES)
+    self.assertEqual(rdeps, {
+        "/external/rust/crates/foo": ({"foo_test", "baz_test"}, {"external/rust/crates/bar"}),
+        "/external/rust/crates/bar": ({"bar_test", "baz_test"}, set()),
+        "/external/rust/crates/qux": ({"qux_test"}, set()),
+    })
+    targets = ("//external/rust/crates/foo:all + //external/rust/crates/bar:all + "
+               "//external/rust/crates/qux:all")
+    self.assertEqual(sorted(self.read_fake(".queries")), sorted([
+        'kind("^rust_test_? rule$", rdeps(//..., ' + targets + '))',
+        'rdeps(//..., ' + targets + ')']))
+
+  def test_query_many_packages_jobs(self):
+    create_file(self.fake_bazel + ".out", GRAPH_TESTS)
+    create_file(self.fake_bazel + ".graph", GRAPH)
+    bazel = self.new_bazel(jobs=4)
+    self.assertEqual(len(bazel.output_bases), 2)
+    rdeps = bazel.query_many_packages(PACKAGES)
+    self.assertEqual(rdeps["/external/rust/crates/qux"], ({"qux_test"}, set()))
+    self.assertEqual(sorted(self.read_fake(".output_bases")), sorted(bazel.output_bases))
+
+
+class MainBatchTestCase(TempDirTestCase):
+
+  def setUp(self):
+    super().setUp()
+    create_file(os.path.join(self.crate, "Android.bp"), "rust_library {}")
+    for (name, patcher) in [
+        ("bazel", mock.patch.object(update_crate_tests, "Bazel")),
+        ("call", mock.patch.object(update_crate_tests.subprocess, "call", return_value=0)),
+        ("run", mock.patch.object(update_crate_tests.subprocess, "run")),
+        ("env", mock.patch.dict(os.environ, {"ANDROID_BUILD_TOP": self.top}))]:
+      setattr(self, name, patcher.start())
+      self.addCleanup(patcher.stop)
+    self.bazel.return_value.query_many_packages.return_value = {
+        "/external/rust/crates/foo": ({"foo_test"}, set())}
+
+  def main_batch(self, **kwargs):
+    with mock.patch("builtins.print"):
+      update_crate_tests.main_batch([self.crate], **kwargs)
+
+  def test_default_does_not_use_cache(self):
+    create_file(update_crate_tests.CACHE_DIR)
+    self.main_batch()
+    self.main_batch()
+    self.assertEqual(self.bazel.call_count, 2)
+    self.assertTrue(os.path.isfile(os.path.join(self.crate, "TEST_MAPPING")))
+
+  def test_skip_unchanged(self):
+    self.main_batch(skip_unchanged=True)
+    self.main_batch(skip_unchanged=True)
+    self.assertEqual(self.bazel.call_count, 1)
+
+  def test_skip_unchanged_unwritable_cache(self):
+    create_file(update_crate_tests.CACHE_DIR)
+    with mock.patch("sys.stderr"):
+      self.main_batch(skip_unchanged=True)
+    self.assertTrue(os.path.isfile(os.path.join(self.crate, "TEST_MAPPING")))
+
+
+if __name__ == '__main__':
+  unittest.main(verbosity=2)